@@ -3,21 +3,24 @@
 import argparse
 import asyncio
 import os
-import pathlib
 import re
 import secrets
+import ssl
 import sys
-import warnings
 
 from concurrent.futures import ThreadPoolExecutor
-from functools import partial, reduce
+from functools import partial
 from itertools import chain
-from typing import Tuple, List, Union, Optional, Iterator, Iterable
-from urllib.parse import quote, urljoin
+from typing import Tuple, List, Optional, Iterator, BinaryIO, TextIO
+from urllib.parse import quote
 
 import requests
+import urllib3
 
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import InsecureRequestWarning
+from urllib3.util.retry import Retry
 
 
 BASE_URL = 'https://www.music.com.bd/download/browse'
@@ -27,9 +30,79 @@ SONG_URL_PATH_REGEX = re.compile(r'(?i)^.*/([^/]+)(?<!\.zip)\.html$')
 # Drop `music.com.bd` substring from song's name
 SONG_NAME_REPLACE_REGEX = re.compile(r'(?:)\s*\(?\s*(?:www\.)?music\.com\.bd\s*\)?\s*')
 
-requests.get = partial(requests.get, verify=False, allow_redirects=True)
+# Size of the chunks read from a song download response
+CHUNK_SIZE = 64 * 1024
+# Buffer size of the song files opened for writing
+WRITE_BUFFER_SIZE = 1024 * 1024
+# Maximum number of requests in flight at once; this sizes the
+# download concurrency, the thread pool and the per-host connection pool
+MAX_PARALLEL_REQUESTS = 16
+
 # Silent requests for verify=False
-warnings.warn = lambda *args, **kwargs: None
+urllib3.disable_warnings(InsecureRequestWarning)
+
+
+class SSLContextAdapter(HTTPAdapter):
+    """`HTTPAdapter` whose connection pools all use the given
+    `ssl.SSLContext` instead of setting up one per connection.
+
+    This only covers direct connections: `proxy_manager_for` is not
+    overridden, so connections made through a proxy still get a
+    context per connection.
+    """
+
+    def __init__(self, *args, ssl_context: ssl.SSLContext, **kwargs) -> None:
+        # Must be set before `HTTPAdapter.__init__` calls
+        # `init_poolmanager`
+        self.ssl_context = ssl_context
+        super().__init__(*args, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs) -> None:
+        kwargs['ssl_context'] = self.ssl_context
+        super().init_poolmanager(*args, **kwargs)
+
+
+def get_ssl_context() -> ssl.SSLContext:
+    """Returns the `ssl.SSLContext` shared by all the HTTPS
+    connections. Certificates are not verified (as with
+    `verify=False`), so no CA certificates are loaded either.
+    """
+
+    ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    ssl_context.check_hostname = False
+    ssl_context.verify_mode = ssl.CERT_NONE
+    return ssl_context
+
+
+def get_session() -> requests.Session:
+    """Returns a `requests.Session` with a connection pool large
+    enough to keep the connections to the album and download hosts
+    alive across all the (parallel) song downloads. Connection errors
+    and transient gateway errors are retried by the adapter.
+    """
+
+    session = requests.Session()
+    retry = Retry(
+        total=2,
+        connect=2,
+        read=2,
+        backoff_factor=0.3,
+        status_forcelist=(502, 503, 504),
+        raise_on_status=False,
+    )
+    adapter = SSLContextAdapter(
+        ssl_context=get_ssl_context(),
+        pool_connections=4,
+        pool_maxsize=MAX_PARALLEL_REQUESTS,
+        max_retries=retry,
+    )
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.get = partial(session.get, verify=False, timeout=(5, 60))
+    return session
+
+
+SESSION = get_session()
 
 
 def get_argument_parser() -> argparse.ArgumentParser:
@@ -107,25 +180,15 @@ def get_parsed_args(
     return artist, parsed_args.album.strip(), destination
 
 
-def _get_joined_url(base: str, *parts: Iterable, append_slash: bool = False) -> str:
+def _get_joined_url(base: str, *parts: str, append_slash: bool = False) -> str:
     """Takes a base url and returns a complete URL join-ing
-    the parts after the base.
+    the (already quoted) parts after the base with slashes.
+    Empty parts are skipped.
     """
-    if not base.endswith('/'):
-        base = base + '/'
-    slashed_parts = (
-        part + '/' if not part.endswith('/') else part
-        for part in parts[:-1]
-    )
-
-    parts = chain(slashed_parts, parts[-1:])
 
-    joined_url = reduce(urljoin, parts, base)
-    return (
-        (joined_url + '/' if not joined_url.endswith('/') else joined_url)
-        if append_slash
-        else joined_url.rstrip('/')
-    )
+    stripped_parts = (part.strip('/') for part in parts)
+    joined_url = '/'.join([base.rstrip('/'), *filter(None, stripped_parts)])
+    return joined_url + '/' if append_slash else joined_url
 
 
 def get_album_url(artist: str, album: str) -> str:
@@ -140,7 +203,11 @@ def get_album_url(artist: str, album: str) -> str:
     )
 
 
-def get_song_download_url(artist: str, album: str, song_url_path: str) -> str:
+def get_song_download_prefix(artist: str, album: str) -> str:
+    """Returns the (slash terminated) download URL of the album
+    which only needs the quoted song URL path appended to get
+    the song's download URL.
+    """
 
     namespace = artist[0].upper()
     return _get_joined_url(
@@ -148,47 +215,98 @@ def get_song_download_url(artist: str, album: str, song_url_path: str) -> str:
         namespace,
         quote(artist),
         quote(album),
-        quote(song_url_path),
-        append_slash=False,
+        append_slash=True,
     )
 
 
-def is_song_url(url: str) -> bool:
-    """Takes a URL and returns whether that is a song URL or not."""
+def _build_song_url(download_prefix: str, song_url_path: str) -> str:
+    """Takes the album's download URL prefix (as returned by
+    `get_song_download_prefix`) and returns the song's download URL.
+    """
 
-    # Song URLs do not contain trailing slash
-    return not url.endswith('/')
+    return download_prefix + quote(song_url_path, safe='')
+
+
+def get_song_download_url(artist: str, album: str, song_url_path: str) -> str:
+
+    return _build_song_url(
+        get_song_download_prefix(artist, album),
+        song_url_path,
+    )
 
 
 async def get_response(
         url: str,
         executor: ThreadPoolExecutor,
-        get_bytes: bool = True,
-) -> Tuple[bool, Union[bytes, str]]:
+) -> Tuple[bool, str]:
     """Takes the URL to send GET request to and returns a
     tuple containing whether we get a successful response
     and the content.
     """
 
-    return_when_error = (False, b'' if get_bytes else '')
-
-    event_loop = asyncio.get_event_loop()
+    event_loop = asyncio.get_running_loop()
 
     try:
-        response = await event_loop.run_in_executor(executor, requests.get, url)
+        response = await event_loop.run_in_executor(executor, SESSION.get, url)
     except requests.exceptions.ConnectionError:
         print(f'Network error while connecting to URL "{url}"', file=sys.stderr)
-        if not is_song_url(url):
-            sys.exit(2)
-        return return_when_error
+        sys.exit(2)
     except Exception:
-        return return_when_error
+        return False, ''
 
     success = response.status_code == 200
-    return (
-        success,
-        response.content if get_bytes else response.text
-    )
+    return success, response.text
+
+
+def _stream_to_file(url: str, fileobj: BinaryIO) -> bool:
+    """Sends a streaming GET request to `url` and writes the
+    content to `fileobj` chunk by chunk. Returns whether we
+    get a successful response.
+
+    This runs as a single job on the executor so that a song
+    download takes only one hop off the event loop.
+    """
+
+    response = SESSION.get(url, stream=True)
+    try:
+        if response.status_code != 200:
+            return False
+        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+            fileobj.write(chunk)
+    finally:
+        response.close()
+
+    return True
+
+
+async def get_streamed_response(
+        url: str,
+        executor: ThreadPoolExecutor,
+        fileobj: BinaryIO,
+        log_queue: 'asyncio.Queue[Optional[Tuple[TextIO, str]]]',
+) -> bool:
+    """Takes the URL to send GET request to and streams the
+    content to `fileobj` as it arrives. Returns whether we
+    get a successful response and the whole content is written.
+    Errors are put on `log_queue` (see `print_messages`).
+    """
+
+    event_loop = asyncio.get_running_loop()
+
+    try:
+        return await event_loop.run_in_executor(
+            executor,
+            _stream_to_file,
+            url,
+            fileobj,
+        )
+    except requests.exceptions.ConnectionError:
+        await log_queue.put(
+            (sys.stderr, f'Network error while connecting to URL "{url}"\n')
+        )
+        return False
+    except Exception:
+        return False
 
 
 async def get_soup(
@@ -202,9 +320,16 @@ async def get_soup(
     success, response = await get_response(
         url=album_url,
         executor=executor,
-        get_bytes=False
     )
-    return BeautifulSoup(response, 'html.parser') if success else None
+    if not success:
+        return None
+
+    # Only build the song links (`a.list-group-item`) into the tree
+    return BeautifulSoup(
+        response,
+        'lxml',
+        parse_only=SoupStrainer('a', class_='list-group-item'),
+    )
 
 
 def get_album_dir(destination: str, artist: str, album: str) -> str:
@@ -212,57 +337,106 @@ def get_album_dir(destination: str, artist: str, album: str) -> str:
     where songs will be saved.
     """
 
-    destination_path = pathlib.Path(destination)
-    destination_path.mkdir(mode=0o755, parents=True, exist_ok=True)
+    os.makedirs(destination, mode=0o755, exist_ok=True)
     album_dir_name = f'{album}_{artist}' if album else f'{artist}'
 
-    append = ''
-    while True:
-        _album_dir_name = f'{album_dir_name}{append}'
-        album_dir_path = destination_path / _album_dir_name
+    album_dir_path = os.path.join(destination, album_dir_name)
 
-        try:
-            album_dir_path.mkdir(mode=0o755, parents=False, exist_ok=False)
-            return str(album_dir_path.resolve())
-        except FileExistsError:
-            append = f'_{secrets.token_hex(5)}'
+    try:
+        os.mkdir(album_dir_path, mode=0o755)
+        return os.path.abspath(album_dir_path)
+    except FileExistsError:
+        pass
 
+    # Create a randomly suffixed directory instead; `os.mkdir`
+    # applies the umask to its mode just like above
+    album_dir_path = f'{album_dir_path}_{secrets.token_hex(5)}'
+    os.mkdir(album_dir_path, mode=0o755)
+    return os.path.abspath(album_dir_path)
 
-def get_song_urls(soup: BeautifulSoup) -> Iterator[str]:
+
+def get_song_urls(soup: BeautifulSoup) -> Iterator[Tuple[str, str]]:
     """Takes the album page soup object and returns an
-    iterator containing the song URL path (without any
-    prefix, only the last portion).
+    iterator containing tuples of the song URL path (without
+    any prefix, only the last portion) and the song's name
+    to save it as.
     """
 
-    songs = soup.select('div.list-group a.list-group-item')
+    songs = soup.find_all('a', class_='list-group-item', href=True)
     for song in songs:
-        if matched_url_path := SONG_URL_PATH_REGEX.search(song['href']):
-            yield matched_url_path.group(1)
+        href = song['href']
+        # Cheap check to skip the regex for the non-song (e.g. the
+        # parent/sub directory) links
+        if href[-5:].lower() != '.html':
+            continue
+        if matched_url_path := SONG_URL_PATH_REGEX.search(href):
+            song_url_path = matched_url_path.group(1)
+            yield song_url_path, SONG_NAME_REPLACE_REGEX.sub('', song_url_path)
+
+
+async def print_messages(log_queue: 'asyncio.Queue[Optional[Tuple[TextIO, str]]]') -> None:
+    """Writes the `(stream, message)` tuples put on `log_queue`
+    to their streams (stdout/stderr) in order until a `None` is
+    received. All the messages queued up at once are written
+    before the streams are flushed.
+    """
+
+    while True:
+        messages = [await log_queue.get()]
+        while not log_queue.empty():
+            messages.append(log_queue.get_nowait())
+
+        streams = set()
+        for message in messages:
+            if message is None:
+                continue
+            stream, text = message
+            stream.write(text)
+            streams.add(stream)
+
+        for stream in streams:
+            stream.flush()
+
+        if None in messages:
+            return None
 
 
 async def download_save_song(
-        song_url_path: str,
-        artist: str,
-        album: str,
+        song: Tuple[str, str],
+        download_prefix: str,
         executor: ThreadPoolExecutor,
         album_dir: str,
+        log_queue: 'asyncio.Queue[Optional[Tuple[TextIO, str]]]',
 ) -> None:
-    """Send GET to the song URL to get the content and save
-    as as a file in the `album_dir`.
+    """Takes a tuple of the song URL path and name (as returned
+    by `get_song_urls`), sends GET to the song URL and streams
+    the content to a file in the `album_dir`. Progress messages
+    are put on `log_queue` (see `print_messages`).
     """
 
-    song_name = SONG_NAME_REPLACE_REGEX.sub('', song_url_path)
-    print(f'Downloading song "{song_name}"')
-
-    song_url = get_song_download_url(artist, album, song_url_path)
-
-    success, downloaded_song = await get_response(song_url, executor)
-    if not success:
-        print(f'Song not found: "{song_name}"')
-        return None
-
-    with open(f'{album_dir}/{song_name}', 'wb') as f:
-        f.write(downloaded_song)
+    song_url_path, song_name = song
+    await log_queue.put((sys.stdout, f'Downloading song "{song_name}"\n'))
+
+    song_url = _build_song_url(download_prefix, song_url_path)
+
+    song_path = os.path.join(album_dir, song_name)
+    # Stream to a private temporary file and move it in place only
+    # when complete, so that neither a failed download nor another
+    # song saved under the same name can clobber a saved song
+    part_path = f'{song_path}.{secrets.token_hex(5)}.part'
+    with open(part_path, 'xb', buffering=WRITE_BUFFER_SIZE) as f:
+        success = await get_streamed_response(
+            song_url,
+            executor,
+            f,
+            log_queue,
+        )
+
+    if success:
+        os.replace(part_path, song_path)
+    else:
+        os.remove(part_path)
+        await log_queue.put((sys.stdout, f'Song not found: "{song_name}"\n'))
 
     return None
 
@@ -273,30 +447,68 @@ async def main() -> None:
     parser = get_argument_parser()
     artist, album, destination = get_parsed_args(parser)
     album_url = get_album_url(artist, album)
-    executor = ThreadPoolExecutor()
+    executor = ThreadPoolExecutor(max_workers=MAX_PARALLEL_REQUESTS)
 
-    soup = await get_soup(album_url, executor)
-    if not soup:
-        print('Album not found!', file=sys.stderr)
-        executor.shutdown()
-        sys.exit(1)
-
-    song_urls = get_song_urls(soup)
     try:
-        first_song_url = next(song_urls)
-    except StopIteration:
-        print('No songs found on the album!', file=sys.stderr)
-        executor.shutdown()
-        sys.exit(0)
+        soup = await get_soup(album_url, executor)
+        if not soup:
+            print('Album not found!', file=sys.stderr)
+            sys.exit(1)
 
-    album_dir = get_album_dir(destination, artist, album)
-    song_urls = chain([first_song_url], song_urls)
-    await asyncio.gather(*[
-        download_save_song(song_url, artist, album, executor, album_dir)
-        for song_url in song_urls
-    ])
+        songs = get_song_urls(soup)
+        try:
+            first_song = next(songs)
+        except StopIteration:
+            print('No songs found on the album!', file=sys.stderr)
+            sys.exit(0)
+
+        album_dir = get_album_dir(destination, artist, album)
+        download_prefix = get_song_download_prefix(artist, album)
+        songs = chain([first_song], songs)
+
+        # Keep at most `MAX_PARALLEL_REQUESTS` downloads in flight so
+        # that they never queue up inside the executor (with their
+        # files already opened)
+        semaphore = asyncio.Semaphore(MAX_PARALLEL_REQUESTS)
+
+        # The downloads only queue up their progress messages, which
+        # are printed by a single task
+        log_queue: 'asyncio.Queue[Optional[Tuple[TextIO, str]]]' = asyncio.Queue()
+        printer_task = asyncio.create_task(print_messages(log_queue))
+
+        async def _download_save_song(song: Tuple[str, str]) -> None:
+            # Report a failed download instead of letting it abort
+            # the rest of the album
+            try:
+                async with semaphore:
+                    return await download_save_song(
+                        song,
+                        download_prefix,
+                        executor,
+                        album_dir,
+                        log_queue,
+                    )
+            except Exception as exc:
+                await log_queue.put(
+                    (sys.stderr, f'Download failed: "{song[1]}": {exc}\n')
+                )
+                return None
+
+        tasks = []
+        for song in songs:
+            tasks.append(asyncio.create_task(_download_save_song(song)))
+            # Yield to the event loop so that the download just scheduled
+            # is started before the rest of the song URLs are matched
+            await asyncio.sleep(0)
+
+        await asyncio.gather(*tasks)
+
+        await log_queue.put(None)
+        await printer_task
+    finally:
+        executor.shutdown()
+        SESSION.close()
 
-    executor.shutdown()
     print(f'\nAll songs saved in "{album_dir}"', end='\n\n')
 
 
@@ -1,6 +1,10 @@
 import argparse
+import asyncio
+import io
 import os
 import re
+import ssl
+import sys
 
 from concurrent.futures import ThreadPoolExecutor
 from unittest.mock import patch
@@ -9,34 +13,34 @@ from urllib.parse import quote
 import pytest
 import requests
 
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 
 from music_downloader import (
     BASE_URL,
+    _build_song_url,
     DOWNLOAD_URL,
     SONG_NAME_REPLACE_REGEX,
+    MAX_PARALLEL_REQUESTS,
+    SSLContextAdapter,
     get_argument_parser,
+    get_session,
     get_parsed_args,
     get_album_url,
+    get_song_download_prefix,
     get_song_download_url,
     get_album_dir,
     get_song_urls,
     get_response,
+    get_streamed_response,
     get_soup,
     download_save_song,
-    is_song_url,
+    print_messages,
 )
 
 
-_album_dir_path_mkdir_called_times = 0
-
-
-def patched_mkdir(*args, **kwargs):
-    global _album_dir_path_mkdir_called_times
-    if kwargs.get('exist_ok') is False:
-        if _album_dir_path_mkdir_called_times == 1:
-            return None
-        _album_dir_path_mkdir_called_times += 1
+def patched_mkdir(path, *args, **kwargs):
+    # Only the album directory without any suffix exists
+    if path.endswith('_Foo Bar'):
         raise FileExistsError
 
 
@@ -51,6 +55,8 @@ def patched_requests_get(*args, success=True, **kwargs):
         response.status_code = 400
         response.text = 'failure'
         response.content = b'failure'
+    response.iter_content = lambda *args, **kwargs: iter([response.content])
+    response.close = lambda: None
     return response
 
 
@@ -62,18 +68,6 @@ def patched_requests_get_failure(*args, **kwargs):
     return patched_requests_get(*args, success=False, **kwargs)
 
 
-def patched_open(*args, **kwargs):
-    Open = type('Open', (object,), {})
-    Open.__enter__ = lambda self, *args, **kwargs: self
-    Open.__exit__ = lambda self, *args, **kwargs: None
-    # Returning `self` from __enter__` and setting `write`
-    # on Open instead of on a file-like object, for easier
-    # making mocking easier (so that we don't need something
-    # like `io.StringIO`/`io.BytesIO`
-    Open.write = Open.__exit__
-    return Open()
-
-
 class TestMusicAlbumDownloader:
     """Unit tests for the music_downloader."""
 
@@ -162,6 +156,20 @@ class TestMusicAlbumDownloader:
                 ],
             )
 
+    def test_get_session(self):
+        session = get_session()
+        adapter = session.get_adapter('https://download.music.com.bd/')
+        assert adapter._pool_maxsize == MAX_PARALLEL_REQUESTS
+        assert adapter.max_retries.total == 2
+        assert 502 in adapter.max_retries.status_forcelist
+        assert isinstance(adapter, SSLContextAdapter)
+        assert adapter.ssl_context.verify_mode == ssl.CERT_NONE
+        assert adapter.ssl_context.cert_store_stats()['x509_ca'] == 0
+        assert adapter.poolmanager.connection_pool_kw['ssl_context'] is (
+            adapter.ssl_context
+        )
+        session.close()
+
     def test_get_album_url(self):
         artist_lower = self.artist.lower()
         assert get_album_url(self.artist, self.album) == (
@@ -169,6 +177,11 @@ class TestMusicAlbumDownloader:
             f'{quote(self.album)}/'
         )
 
+    def test_get_album_url_empty_album(self):
+        assert get_album_url(self.artist, '') == (
+            f'{BASE_URL}/{self.artist[0].upper()}/{quote(self.artist)}/'
+        )
+
     def test_get_song_download_url(self):
         artist_lower = self.artist.lower()
         song_url_path = '07. Foo Bar.mp3'
@@ -177,18 +190,32 @@ class TestMusicAlbumDownloader:
             f'{quote(self.album)}/{quote(song_url_path)}'
         )
 
-    @patch('pathlib.Path.mkdir', return_value=None)
-    def test_get_album_dir(self, patched_mkdir):
+    def test_get_song_download_prefix(self):
+        artist_lower = self.artist.lower()
+        assert get_song_download_prefix(self.artist, self.album) == (
+            f'{DOWNLOAD_URL}/{artist_lower[0].upper()}/{quote(self.artist)}/'
+            f'{quote(self.album)}/'
+        )
+
+    @patch('os.mkdir', return_value=None)
+    @patch('os.makedirs', return_value=None)
+    def test_get_album_dir(self, patched_makedirs, patched_mkdir):
         assert get_album_dir(
             destination=self.destination,
             artist=self.artist,
             album=self.album,
         ) == f'{self.destination.rstrip("/")}/{self.album}_{self.artist}'
 
-        assert patched_mkdir.call_count == 2
+        assert patched_makedirs.call_count == 1
+        assert patched_mkdir.call_count == 1
 
-    @patch('pathlib.Path.mkdir', side_effect=patched_mkdir)
-    def test_get_album_dir_file_exists_error(self, patched_mkdir):
+    @patch('os.mkdir', side_effect=patched_mkdir)
+    @patch('os.makedirs', return_value=None)
+    def test_get_album_dir_file_exists_error(
+            self,
+            patched_makedirs,
+            patched_mkdir,
+    ):
         assert re.search(
             (
                 rf'^{self.destination.rstrip("/")}/{self.album}_'
@@ -200,7 +227,8 @@ class TestMusicAlbumDownloader:
                 album=self.album,
             )
         )
-        assert patched_mkdir.call_count == 3
+        assert patched_mkdir.call_count == 2
+        assert patched_mkdir.call_args.kwargs['mode'] == 0o755
 
     def test_get_song_urls(self):
 
@@ -234,8 +262,27 @@ class TestMusicAlbumDownloader:
         </div>
         '''
 
+        expected_songs = [
+            (
+                '07 - Aashor -  Maya (music.com.bd).mp3',
+                '07 - Aashor -  Maya.mp3',
+            ),
+            (
+                'Aashor - Mohasrishtyr Gan (music.com.bd).mp3',
+                'Aashor - Mohasrishtyr Gan.mp3',
+            ),
+        ]
+
         soup = BeautifulSoup(html, 'html.parser')
-        assert len(list(get_song_urls(soup))) == 2
+        assert list(get_song_urls(soup)) == expected_songs
+
+        # As built by `get_soup`
+        soup = BeautifulSoup(
+            html,
+            'lxml',
+            parse_only=SoupStrainer('a', class_='list-group-item'),
+        )
+        assert list(get_song_urls(soup)) == expected_songs
 
     def test_get_song_urls_no_match(self):
 
@@ -273,29 +320,52 @@ class TestMusicAlbumDownloader:
         assert len(list(get_song_urls(soup))) == 0
 
     @pytest.mark.asyncio
-    @patch('requests.get', side_effect=patched_requests_get_success)
+    @patch('music_downloader.SESSION.get', side_effect=patched_requests_get_success)
     async def test_get_response_success(self, patched_requests_get):
         success, response_content = await get_response(
             url='https://music.com.bd',
             executor=ThreadPoolExecutor(),
-            get_bytes=True,
         )
         assert success
-        assert response_content == b'success'
+        assert response_content == 'success'
 
     @pytest.mark.asyncio
-    @patch('requests.get', side_effect=patched_requests_get_failure)
+    @patch('music_downloader.SESSION.get', side_effect=patched_requests_get_failure)
     async def test_get_response_failure(self, patched_requests_get):
         success, response_content = await get_response(
             url='https://music.com.bd',
             executor=ThreadPoolExecutor(),
-            get_bytes=False,
         )
         assert not success
         assert response_content == 'failure'
 
     @pytest.mark.asyncio
-    @patch('requests.get', side_effect=patched_requests_get_success)
+    @patch('music_downloader.SESSION.get', side_effect=patched_requests_get_success)
+    async def test_get_streamed_response_success(self, patched_requests_get):
+        fileobj = io.BytesIO()
+        assert await get_streamed_response(
+            url='https://music.com.bd/foo/spam.mp3',
+            executor=ThreadPoolExecutor(),
+            fileobj=fileobj,
+            log_queue=asyncio.Queue(),
+        )
+        assert fileobj.getvalue() == b'success'
+        assert patched_requests_get.call_args.kwargs['stream']
+
+    @pytest.mark.asyncio
+    @patch('music_downloader.SESSION.get', side_effect=patched_requests_get_failure)
+    async def test_get_streamed_response_failure(self, patched_requests_get):
+        fileobj = io.BytesIO()
+        assert not await get_streamed_response(
+            url='https://music.com.bd/foo/spam.mp3',
+            executor=ThreadPoolExecutor(),
+            fileobj=fileobj,
+            log_queue=asyncio.Queue(),
+        )
+        assert fileobj.getvalue() == b''
+
+    @pytest.mark.asyncio
+    @patch('music_downloader.SESSION.get', side_effect=patched_requests_get_success)
     async def test_get_soup(self, patched_requests_get):
         assert isinstance(
             await get_soup(
@@ -306,7 +376,7 @@ class TestMusicAlbumDownloader:
         )
 
     @pytest.mark.asyncio
-    @patch('requests.get', side_effect=requests.exceptions.ConnectionError)
+    @patch('music_downloader.SESSION.get', side_effect=requests.exceptions.ConnectionError)
     async def test_get_soup_system_exit(self, patched_requests_get):
         with pytest.raises(SystemExit):
             assert await get_soup(
@@ -336,18 +406,95 @@ class TestMusicAlbumDownloader:
         ) == '01. Foo - Bar.mp3'
 
     @pytest.mark.asyncio
-    @patch('requests.get', side_effect=patched_requests_get_success)
-    @patch('builtins.open', side_effect=patched_open)
-    async def test_download_save_song(self, patched_open, patched_requests_get):
+    @patch('music_downloader.SESSION.get', side_effect=patched_requests_get_success)
+    async def test_download_save_song(self, patched_requests_get, tmp_path):
+        log_queue = asyncio.Queue()
         assert await download_save_song(
-            song_url_path='https://music.com.bd',
-            artist=self.artist,
-            album=self.album,
+            song=('foo (music.com.bd).mp3', 'foo.mp3'),
+            download_prefix=get_song_download_prefix(self.artist, self.album),
             executor=ThreadPoolExecutor(),
-            album_dir=self.destination,
+            album_dir=str(tmp_path),
+            log_queue=log_queue,
         ) is None
-        assert patched_open.call_count == 1
+        assert (tmp_path / 'foo.mp3').read_bytes() == b'success'
+        assert log_queue.get_nowait() == (
+            sys.stdout,
+            'Downloading song "foo.mp3"\n',
+        )
+        assert log_queue.empty()
 
-    def test_is_song_url(self):
-        assert is_song_url('https://music.com.bd/foo/spam.mp3')
-        assert not is_song_url('https://music.com.bd/foo/')
+    @pytest.mark.asyncio
+    @patch('music_downloader.SESSION.get', side_effect=patched_requests_get_failure)
+    async def test_download_save_song_not_found(self, patched_requests_get, tmp_path):
+        log_queue = asyncio.Queue()
+        assert await download_save_song(
+            song=('foo.mp3', 'foo.mp3'),
+            download_prefix=get_song_download_prefix(self.artist, self.album),
+            executor=ThreadPoolExecutor(),
+            album_dir=str(tmp_path),
+            log_queue=log_queue,
+        ) is None
+        assert not os.listdir(tmp_path)
+        assert log_queue.get_nowait() == (
+            sys.stdout,
+            'Downloading song "foo.mp3"\n',
+        )
+        assert log_queue.get_nowait() == (
+            sys.stdout,
+            'Song not found: "foo.mp3"\n',
+        )
+
+    @pytest.mark.asyncio
+    async def test_print_messages(self, capsys):
+        log_queue = asyncio.Queue()
+        for message in (
+                (sys.stdout, 'foo\n'),
+                (sys.stderr, 'spam\n'),
+                (sys.stdout, 'bar\n'),
+                None,
+        ):
+            log_queue.put_nowait(message)
+
+        assert await print_messages(log_queue) is None
+        captured = capsys.readouterr()
+        assert captured.out == 'foo\nbar\n'
+        assert captured.err == 'spam\n'
+
+    @pytest.mark.asyncio
+    @patch('music_downloader.SESSION.get', side_effect=requests.exceptions.ConnectionError)
+    async def test_get_streamed_response_network_error(self, patched_requests_get):
+        log_queue = asyncio.Queue()
+        assert not await get_streamed_response(
+            url='https://music.com.bd/foo/spam.mp3',
+            executor=ThreadPoolExecutor(),
+            fileobj=io.BytesIO(),
+            log_queue=log_queue,
+        )
+        stream, message = log_queue.get_nowait()
+        assert stream is sys.stderr
+        assert message.startswith('Network error')
+
+    @pytest.mark.asyncio
+    async def test_download_save_song_same_name(self, tmp_path):
+        download_prefix = get_song_download_prefix(self.artist, self.album)
+
+        def patched_requests_get_by_url(url, *args, **kwargs):
+            if url == _build_song_url(download_prefix, 'C (music.com.bd).mp3'):
+                return patched_requests_get_success(url, *args, **kwargs)
+            return patched_requests_get_failure(url, *args, **kwargs)
+
+        with patch(
+                'music_downloader.SESSION.get',
+                side_effect=patched_requests_get_by_url,
+        ):
+            for song_url_path in ('C (music.com.bd).mp3', 'C(music.com.bd).mp3'):
+                assert await download_save_song(
+                    song=(song_url_path, 'C.mp3'),
+                    download_prefix=download_prefix,
+                    executor=ThreadPoolExecutor(),
+                    album_dir=str(tmp_path),
+                    log_queue=asyncio.Queue(),
+                ) is None
+
+        assert os.listdir(tmp_path) == ['C.mp3']
+        assert (tmp_path / 'C.mp3').read_bytes() == b'success'